@@ -0,0 +1,89 @@
+# coding: utf-8
+import threading
+import time
+
+# metadata collections that name the devices of a vendor: (collection, series name format, id key, name key)
+_LABEL_SOURCES = [('wirelesstag', 'wirelesstag.{}', 'uuid', 'tag_name'),
+                  ('ic_meters', 'ic-meter.{}', 'boxId', 'name')]
+
+
+class DeviceCatalog:
+    """
+    The series the dashboard can show, with their labels and measures. Series and measures are the field keys
+    in Influx, labels come from the metadata the collectors store in Mongo. The catalog is held in memory and
+    reloaded in the background once it is older than refresh_ahead * ttl, so readers never wait on a database
+    after the first load.
+    """
+
+    def __init__(self, ts_db, metadata_db=None, ttl=300, refresh_ahead=0.8, label_sources=None):
+        self.ts_db = ts_db
+        self.metadata_db = metadata_db
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.label_sources = _LABEL_SOURCES if label_sources is None else label_sources
+        # series name -> (label, [measures])
+        self._catalog = {}
+        self._loaded_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def devices(self):
+        """
+        Return [(series name, label)] sorted by label
+        """
+        catalog = self.get()
+        return sorted(((name, entry[0]) for name, entry in catalog.items()), key=lambda device: device[1].lower())
+
+    def measures(self, series_name):
+        entry = self.get().get(series_name)
+        return list(entry[1]) if entry else []
+
+    def get(self):
+        with self._lock:
+            catalog, loaded_at = self._catalog, self._loaded_at
+            stale = loaded_at is None or time.time() - loaded_at >= self.ttl * self.refresh_ahead
+            if stale and not self._refreshing:
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh_async, name='device-catalog')
+                thread.daemon = True
+                thread.start()
+        return catalog
+
+    def refresh(self):
+        """
+        Reload the catalog now, the previous one is kept when the databases cannot be read
+        """
+        try:
+            catalog = self.load()
+        except Exception as e:
+            print('Loading the device catalog failed: %s' % e)
+            with self._lock:
+                return self._catalog
+        with self._lock:
+            self._catalog, self._loaded_at = catalog, time.time()
+        return catalog
+
+    def load(self):
+        labels = self.load_labels()
+        catalog = {}
+        for series_name, fields in self.ts_db.get_all_field_keys().items():
+            if fields:
+                catalog[series_name] = (labels.get(series_name, series_name), sorted(fields))
+        return catalog
+
+    def load_labels(self):
+        labels = {}
+        if self.metadata_db is None:
+            return labels
+        for collection, series_format, id_key, name_key in self.label_sources:
+            for doc in self.metadata_db.get_all(collection, limit=0):
+                if doc.get(id_key) is not None and doc.get(name_key):
+                    labels[series_format.format(doc[id_key])] = doc[name_key].strip()
+        return labels
+
+    def _refresh_async(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,54 @@
+# coding: utf-8
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a series to n_out points. x may be numeric or datetime64 and
+    must be sorted; NaN values of y are dropped. Returns the selected (x, y).
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    if not valid.all():
+        x, y = x[valid], y[valid]
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    xs = x.astype('datetime64[ns]').astype(np.int64) if x.dtype.kind == 'M' else x
+    xs = xs.astype(np.float64)
+
+    # the first and last point are kept, the points in between are split into n_out - 2 buckets
+    edges = (np.arange(n_out - 1) * (float(n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    starts, ends = edges[:-1], edges[1:]
+    counts = (ends - starts).astype(np.float64)
+    avg_x = np.add.reduceat(xs[:n - 1], starts) / counts
+    avg_y = np.add.reduceat(y[:n - 1], starts) / counts
+    # each bucket is compared against the average of the next one, the last against the final point
+    next_x = np.append(avg_x[1:], xs[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        s, e = starts[i], ends[i]
+        area = np.abs((xs[a] - next_x[i]) * (y[s:e] - y[a]) - (xs[a] - xs[s:e]) * (next_y[i] - y[a]))
+        a = s + int(np.argmax(area))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def envelope(x, low, high):
+    """
+    Interleave the minimum and maximum of each bucket of a downsampled series, so a line through the result
+    keeps the peaks that the bucket means flatten; lttb on it then selects among the extremes. Buckets missing
+    either value are dropped.
+    """
+    x = np.asarray(x)
+    low = np.asarray(low, dtype=np.float64)
+    high = np.asarray(high, dtype=np.float64)
+    valid = ~(np.isnan(low) | np.isnan(high))
+    return np.repeat(x[valid], 2), np.column_stack([low[valid], high[valid]]).ravel()
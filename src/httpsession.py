@@ -0,0 +1,104 @@
+# coding: utf-8
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# vendor -> the adapter holding its connection pool, and the session shared by its cookieless calls
+_adapters = {}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _adapter(vendor, pool_connections, pool_maxsize):
+    # called with _lock held
+    adapter = _adapters.get(vendor)
+    if adapter is None:
+        adapter = _adapters[vendor] = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    elif adapter._pool_connections < pool_connections or adapter._pool_maxsize < pool_maxsize:
+        # a larger pool replaces the vendor's, sessions already mounted on the old one keep it until they go away
+        adapter = _adapters[vendor] = HTTPAdapter(pool_connections=max(pool_connections, adapter._pool_connections),
+                                                  pool_maxsize=max(pool_maxsize, adapter._pool_maxsize))
+    return adapter
+
+
+def _mounted(adapter):
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(vendor, pool_connections=4, pool_maxsize=10):
+    """
+    Return the shared keep-alive session of a vendor, creating it on first use. pool_connections is the number of
+    hosts kept in the pool, pool_maxsize the number of connections kept open per host; the pool of a vendor grows
+    to the largest sizes asked for.
+    """
+    with _lock:
+        adapter = _adapter(vendor, pool_connections, pool_maxsize)
+        session = _sessions.get(vendor)
+        if session is None:
+            session = _sessions[vendor] = _mounted(adapter)
+        elif session.get_adapter('https://') is not adapter:
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+
+def new_session(vendor, pool_connections=4, pool_maxsize=10):
+    """
+    Return a session with a cookie jar of its own on the connection pool of a vendor, for clients signed in to
+    one account each; the shared session would mix the cookies of all accounts of the vendor
+    """
+    with _lock:
+        return _mounted(_adapter(vendor, pool_connections, pool_maxsize))
+
+
+def session_stats(vendor=None):
+    """
+    Return {vendor: {'requests': n, 'connections': n, 'reused': n}} counted over the connection pools of each
+    session, where reused is the number of requests that did not have to open a new connection
+    """
+    with _lock:
+        vendors = [vendor] if vendor else list(_adapters.keys())
+        stats = {}
+        for name in vendors:
+            num_requests = num_connections = 0
+            pools = _adapters[name].poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+            stats[name] = {'requests': num_requests, 'connections': num_connections,
+                           'reused': num_requests - num_connections}
+        return stats
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        for adapter in _adapters.values():
+            adapter.close()
+        _sessions.clear()
+        _adapters.clear()
+
+
+def make_post_request(vendor, pool_connections=4, pool_maxsize=10):
+    """
+    Return a replacement for lnetatmo.postRequest that goes through the pooled session of vendor. Like the
+    original, an HTTP error is reported and returns None rather than raising.
+    """
+    def postRequest(url, params=None, timeout=10):
+        session = get_session(vendor, pool_connections, pool_maxsize)
+        r = session.post(url, data=params, timeout=timeout,
+                         headers={"Content-Type": "application/x-www-form-urlencoded;charset=utf-8"})
+        if r.status_code >= 400:
+            print('code=%s, reason=%s' % (r.status_code, r.reason))
+            return None
+        if r.headers.get('Content-Type', '').startswith('application/json'):
+            return r.json()
+        return r.content
+    return postRequest
@@ -1,9 +1,10 @@
 # coding: utf-8
 import logging
 import pytz
-import re
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from mongodb import MongoConnection
 
@@ -13,6 +14,7 @@ import requests
 from apscheduler.schedulers.blocking import BlockingScheduler
 from lnetatmo import *
 
+from httpsession import get_session
 from influxtsdb import InfluxTSDB
 
 logging.basicConfig(level=logging.INFO)
@@ -20,12 +22,17 @@ log = logging.getLogger('apscheduler.executors.default')
 
 
 class IcMeter:
-    def __init__(self, user, password, verbose=True, timeout=5000):
+    def __init__(self, user, password, verbose=True, timeout=5000, workers=4, box_workers=1):
         self.user = user
         self.password = password
         self.timeout = timeout
         self.verbose = verbose
+        # number of windows fetched concurrently per box, and of boxes imported concurrently
+        self.workers = workers
+        self.box_workers = box_workers
+        self.session = get_session('ic-meter', pool_maxsize=max(10, workers * box_workers))
         self.ts_name = 'ic-meter.{}'
+        self.metadata_db = None
 
     def set_timeseries_db(self, ts_db):
         self.ts_db = ts_db
@@ -44,7 +51,7 @@ class IcMeter:
         headers = {"user-agent": "curl/7.43.0"}
         url = "https://app.ic-meter.com/icm/oauth/token?client_id=trusted-client&grant_type=password&scope=read&username=%s&password=%s" % (
             self.user, self.password)
-        r = requests.get(url, headers=headers, allow_redirects=False, timeout=self.timeout)
+        r = self.session.get(url, headers=headers, allow_redirects=False, timeout=self.timeout)
         if r.status_code == 200:
             session = json.loads(r.text)
             self.access_token = session['access_token']
@@ -56,41 +63,46 @@ class IcMeter:
     def get_boxes(self):
         url = "https://app.ic-meter.com/icm/api/boxlocations?access_token=%s&_=%s" % (
             self.access_token, int(round(time.time() * 1000)))
-        r = requests.get(url, allow_redirects=False, timeout=self.timeout)
+        r = self.session.get(url, allow_redirects=False, timeout=self.timeout)
         if r.status_code == 200:
             # save boxes metadata into MongoDB
             boxes = json.loads(r.text)
-            #self.save_boxes(boxes)
+            if self.metadata_db is not None:
+                self.save_boxes(boxes)
             return boxes
         else:
             raise Exception(r.text)
 
     def save_boxes(self, boxes):
-        for box in boxes:
-            print(box)
-            #self.metadata_db.update_upsert('ic_meters', {'boxid':box['boxId']}, box)
+        return self.metadata_db.bulk_upsert('ic_meters', boxes, 'boxId')
 
     def import_missing(self):
         self.get_access_token()
         boxes = self.get_boxes()
+        # resolve all watermarks up front, get_start_timestamp is then served from the cache
+        self.ts_db.get_last_timestamps([self.ts_name.format(box['boxId']) for box in boxes])
 
-        for box in boxes:
-            box_id = box['boxId']
-            self.tz = pytz.timezone(box['timezone'])
+        with ThreadPoolExecutor(max_workers=self.box_workers) as executor:
+            for future in [executor.submit(self.import_box, box) for box in boxes]:
+                future.result()
 
-            start = self.get_start_timestamp(self.ts_name.format(box_id))
-            if start == None:
-                start = int(box['fromdate'] / 1000)
-            else:
-                start = int(start)
+    def import_box(self, box):
+        box_id = box['boxId']
+        tz = pytz.timezone(box['timezone'])
 
-            stop = int(time.time())
-            if 'lastMeasurementDate' in box:
-                stop = int(box['lastMeasurementDate'] / 1000)
+        start = self.get_start_timestamp(self.ts_name.format(box_id))
+        if start == None:
+            start = int(box['fromdate'] / 1000)
+        else:
+            start = int(start)
+
+        stop = int(time.time())
+        if 'lastMeasurementDate' in box:
+            stop = int(box['lastMeasurementDate'] / 1000)
 
-            self.import_all_points(box_id, start, stop, 60 * 60 * 24 * 7)
+        self.import_all_points(box_id, start, stop, 60 * 60 * 24 * 7, tz=tz)
 
-    def import_all_points(self, box_id, start, stop, period=60 * 60 * 24 * 7):
+    def import_all_points(self, box_id, start, stop, period=60 * 60 * 24 * 7, tz=pytz.utc):
         if start >= stop:
             print("No new data available for {}, skipping\n".format(box_id))
             return
@@ -98,24 +110,18 @@ class IcMeter:
         print("Downloading data of box %s  from %i to %i\n" % (box_id, start, stop))
         now = time.time()
         count = 0
-        for f in range(start, stop, period):
+        for f, data in self.iter_periods(box_id, range(start, stop, period), period, tz):
             completed = 100.0 * (f - start) / (stop - start)
             delta = time.time() - now
 
             if self.verbose:
                 if delta > 10:
                     timeleft = int((100.0 - completed) * (delta / completed))
-                    print("Completed: %0.0f%% (%i seconds left)\n" % (completed, timeleft)),
+                    print("Completed box %s: %0.0f%% (%i seconds left)\n" % (box_id, completed, timeleft)),
                 else:
-                    print("Completed: %0.0f%%\n" % completed),
+                    print("Completed box %s: %0.0f%%\n" % (box_id, completed)),
                 sys.stdout.flush()
 
-            data = self.get_data_period(box_id, f, period)
-            if type(data) != pd.core.frame.DataFrame:
-                time.sleep(3)
-                print('Retrying...')
-                data = self.get_data_period(box_id, f, period)
-
             if (type(data) == pd.core.frame.DataFrame) and (not data.empty):
                 count += data.shape[0]
                 self.ts_db.write_ts(self.ts_name.format(box_id), data)
@@ -126,12 +132,36 @@ class IcMeter:
             delta = time.time() - now
         print("Type=info msg=\"Task completed\" elapsed_time=%0.0f rows_written=%i \n" % (delta, count))
 
-    def get_data_period(self, box_id, start=1498720785, period=60 * 60 * 24 * 7.0):
+    def iter_periods(self, box_id, starts, period, tz=pytz.utc):
+        """
+        Fetch the windows beginning at starts with up to self.workers requests in flight, and yield
+        (start, data) in the order of starts
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for f in starts:
+                pending.append((f, executor.submit(self.get_data_period_retry, box_id, f, period, tz)))
+                if len(pending) >= self.workers:
+                    f, future = pending.popleft()
+                    yield f, future.result()
+            while pending:
+                f, future = pending.popleft()
+                yield f, future.result()
+
+    def get_data_period_retry(self, box_id, start, period, tz=pytz.utc):
+        data = self.get_data_period(box_id, start, period, tz)
+        if type(data) != pd.core.frame.DataFrame:
+            time.sleep(3)
+            print('Retrying...')
+            data = self.get_data_period(box_id, start, period, tz)
+        return data
+
+    def get_data_period(self, box_id, start=1498720785, period=60 * 60 * 24 * 7.0, tz=pytz.utc):
         utc = pytz.timezone('UTC')
-        fromdate = self.tz.normalize(self.tz.localize(datetime.fromtimestamp(start))).astimezone(
+        fromdate = tz.normalize(tz.localize(datetime.fromtimestamp(start))).astimezone(
             utc).isoformat().replace(
             '+00:00', 'Z')
-        todate = self.tz.normalize(self.tz.localize(datetime.fromtimestamp(start + period))).astimezone(
+        todate = tz.normalize(tz.localize(datetime.fromtimestamp(start + period))).astimezone(
             utc).isoformat().replace(
             '+00:00', 'Z')
 
@@ -140,46 +170,44 @@ class IcMeter:
             box_id, self.access_token, fromdate, todate, timestamp)
         #print data_url
 
-        r = requests.get(data_url, timeout=self.timeout)
+        r = self.session.get(data_url, timeout=self.timeout)
 
         if r.status_code != 200:
-            r = requests.get(data_url, timeout=self.timeout)
+            r = self.session.get(data_url, timeout=self.timeout)
         if r.status_code != 200:
-            r = requests.get(data_url, timeout=self.timeout)
+            r = self.session.get(data_url, timeout=self.timeout)
         if r.status_code != 200:
             print('Failed to get data for boxid={}'.format(box_id))
 
         json = r.json()
-        return self.convert_to_df(json)
-
-    def convert_to_df(self, json):
-        numberOfRows = len(json['rows'])
-
-        columns = []
-        col_types = []
-        for col in json['cols']:
-            columns.append(col['id'])
-            col_types.append(col['type'])
-
-        df = pd.DataFrame(index=np.arange(0, numberOfRows), columns=columns)
-        for x in np.arange(0, numberOfRows):
-            values = []
-            for i, value in enumerate(json['rows'][x]['c']):
-                if col_types[i] == 'datetime':
-                    m = re.findall(r'Date\((\d+)\,(\d+)\,(\d+)\,(\d+)\,(\d+)\,(\d+)\)', value['v'])[0]
-                    row_time = self.tz.localize(
-                        datetime(int(m[0]), int(m[1]) + 1, int(m[2]), int(m[3]), int(m[4]), int(m[5]))).isoformat()
-                    values.append(row_time)
-                else:
-                    if value['v'] == None:
-                        values.append(float(0))
-                    else:
-                        values.append(float(value['v']))
-            df.loc[x] = values
-        df.index = pd.to_datetime(df["realtime"])
-        df = df.drop("realtime", 1)
-        df.index.name = "time"
-        return df
+        return self.convert_to_df(json, tz)
+
+    def convert_to_df(self, json, tz=pytz.utc):
+        columns = [col['id'] for col in json['cols']]
+        col_types = [col['type'] for col in json['cols']]
+        time_col = col_types.index('datetime')
+        value_cols = [i for i, col_type in enumerate(col_types) if i != time_col]
+
+        if not json['rows']:
+            return pd.DataFrame(columns=[columns[i] for i in value_cols], dtype=np.float64)
+
+        # pull every cell out once, then work column-wise on typed arrays
+        cells = np.array([[value['v'] for value in row['c']] for row in json['rows']], dtype=object)
+
+        # 'Date(y,m,d,h,mi,s)' with a zero-based month, in the local time of the box
+        stamps = ','.join(cells[:, time_col]).replace('Date(', '').replace(')', '')
+        parts = pd.DataFrame(np.array(stamps.split(','), dtype=np.int64).reshape(-1, 6),
+                             columns=['year', 'month', 'day', 'hour', 'minute', 'second'])
+        parts['month'] += 1
+        # same choice as pytz localize(is_dst=False) for ambiguous and skipped local times
+        index = pd.DatetimeIndex(pd.to_datetime(parts))
+        index = index.tz_localize(tz, ambiguous=np.zeros(len(index), dtype=bool),
+                                  nonexistent=pd.Timedelta(hours=1)).tz_convert('UTC')
+        index.name = "time"
+
+        values = cells[:, value_cols]
+        values[np.equal(values, None)] = 0.0
+        return pd.DataFrame(values.astype(np.float64), index=index, columns=[columns[i] for i in value_cols])
 
 
 if __name__ == '__main__':
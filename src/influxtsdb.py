@@ -1,18 +1,168 @@
 # coding: utf-8
+import atexit
+import threading
+import time
+import zlib
 
-
-from influxdb import DataFrameClient
+import numpy as np
+import pandas as pd
+from influxdb import DataFrameClient, InfluxDBClient
 from influxdb.client import InfluxDBClientError
 
+from httpsession import get_session
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+# nanoseconds per unit of each write precision
+_PRECISIONS = {'n': 1, 'u': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+
+
+def _epoch(value):
+    """
+    Seconds since the epoch of a timestamp given as epoch seconds, string or datetime, naive times are UTC
+    """
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return int(value)
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize('UTC')
+    return int(value.value // 10 ** 9)
+
+
+def _quote(name):
+    # measurement names go into queries as double quoted identifiers
+    return '"%s"' % _str(name).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _time_filter(start=None, end=None):
+    where = []
+    if start is not None:
+        where.append('time >= %is' % _epoch(start))
+    if end is not None:
+        where.append('time <= %is' % _epoch(end))
+    return ' where ' + ' and '.join(where) if where else ''
+
+
+def _str(value):
+    # str() of non-ASCII unicode fails under Python 2, where lines are built as UTF-8 byte strings
+    if isinstance(value, text_type) and text_type is not str:
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _escape(name, chars=', ='):
+    name = _str(name)
+    for c in chars:
+        name = name.replace(c, '\\' + c)
+    return name
+
+
+def _encode_field(name, values):
+    """
+    Return an object array of 'name=value' strings for a column, with None where the value is missing
+    """
+    key = _escape(name) + '='
+    if values.dtype.kind == 'f':
+        # Influx has no literal for inf, a line with one is rejected together with the rest of its batch
+        missing = ~np.isfinite(values)
+        encoded = values.astype(str).astype(object)
+    elif values.dtype.kind == 'b':
+        missing = np.zeros(len(values), dtype=bool)
+        encoded = np.where(values, 'true', 'false').astype(object)
+    elif values.dtype.kind in 'iu':
+        missing = np.zeros(len(values), dtype=bool)
+        encoded = values.astype(str).astype(object) + 'i'
+    else:
+        missing = pd.isnull(values)
+        encoded = np.array(['"%s"' % _str(v).replace('\\', '\\\\').replace('"', '\\"') for v in values], dtype=object)
+    encoded = key + encoded
+    encoded[missing] = None
+    return encoded
+
+
+def encode_lines(measurement, df, tags=None, precision='s'):
+    """
+    Encode the rows of a frame as InfluxDB line protocol with timestamps in the given precision. Missing fields are
+    left out and rows without any field are skipped. A naive index is taken as UTC.
+    """
+    if not len(df):
+        return []
+    prefix = _escape(measurement, ', ')
+    for key, value in sorted((tags or {}).items()):
+        prefix += ',%s=%s' % (_escape(key), _escape(value))
+
+    columns = [_encode_field(col, df[col].values) for col in df.columns]
+    timestamps = pd.DatetimeIndex(df.index).values.astype('datetime64[ns]').astype(np.int64) // _PRECISIONS[precision]
+    suffix = (' ' + timestamps.astype(str).astype(object))
+
+    if not any(np.equal(col, None).any() for col in columns):
+        fields = columns[0]
+        for col in columns[1:]:
+            fields = fields + ',' + col
+        return list((prefix + ' ') + fields + suffix)
+
+    lines = []
+    for i, row in enumerate(zip(*columns)):
+        fields = ','.join(field for field in row if field is not None)
+        if fields:
+            lines.append(prefix + ' ' + fields + suffix[i])
+    return lines
+
 
 class InfluxTSDB:
-    def __init__(self, dbhost='localhost', dbport=8086, dbuser='root', dbpassword='root', dbname='test'):
+    def __init__(self, dbhost='localhost', dbport=8086, dbuser='root', dbpassword='root', dbname='test',
+                 batch_points=0, flush_interval=10, max_buffered_points=500000, max_retries=3, retry_delay=1,
+                 precision='s', compress=True, pool_size=None, ssl=False, verify_ssl=False, timeout=30,
+                 watermark_ttl=300):
+        # pool_size is the number of HTTP connections kept open to the server, the client's default when None
+        self.pool_size = pool_size
+        # seconds to wait for the server on queries and writes
+        self.timeout = timeout
         if dbhost != None:
-            self.influxdb = DataFrameClient(dbhost, dbport, dbuser, dbpassword, dbname)
+            options = {'ssl': ssl, 'verify_ssl': verify_ssl, 'timeout': timeout}
+            if pool_size:
+                options['pool_size'] = pool_size
+            self.influxdb = DataFrameClient(dbhost, dbport, dbuser, dbpassword, dbname, **options)
             self.dbname = dbname
+            # writes bypass DataFrameClient and post line protocol directly, to the same server the same way
+            scheme = getattr(self.influxdb, '_scheme', 'https' if ssl else 'http')
+            self._write_url = '%s://%s:%s/write' % (scheme, dbhost, dbport)
+            self._write_verify = getattr(self.influxdb, '_verify_ssl', verify_ssl)
+            self._write_params = {'db': dbname, 'u': dbuser, 'p': dbpassword, 'precision': precision}
+        # timestamp precision of writes, sub-precision parts of the timestamps are truncated
+        self.precision = precision
+        self.compress = compress
+        # series name -> (last timestamp written or read, time cached), so polling does not have to ask the server.
+        # Entries are trusted for watermark_ttl seconds, after that the server is asked again so writes of other
+        # processes are seen.
+        self.watermark_ttl = watermark_ttl
+        self._watermarks = {}
+        self._write_listeners = []
+        self._lock = threading.Lock()
 
+        # with batch_points > 0, write_ts only queues the frame and a background thread writes the queued frames
+        # once batch_points have been collected or flush_interval seconds have passed. write_ts blocks while
+        # max_buffered_points are queued or being written.
+        self.batch_points = batch_points
+        self.flush_interval = flush_interval
+        self.max_buffered_points = max_buffered_points
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._buffer = []
+        self._queued_points = 0
+        self._pending_points = 0
+        self._flushing = False
+        self._flush_requested = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._writer = None
 
     def drop_db(self):
+        # the dropped series must be imported again from the start
+        self.invalidate_watermarks()
         try:
             self.influxdb.drop_database(self.dbname)
         except InfluxDBClientError, e:
@@ -29,24 +179,355 @@ class InfluxTSDB:
         return False
 
     def check_ts(self, series_name, prop='*'):
-        q = 'select %s from \"%s\" limit 1;' % (prop, series_name)
+        q = 'select %s from %s limit 1;' % (prop, _quote(series_name))
         result = self.influxdb.query(q)
         return result[series_name].index[0]
 
-    def get_ts(self, series_name, prop='*'):
-        q = 'select %s from \"%s\" order by time asc;' % (prop, series_name)
+    def get_ts(self, series_name, fields=None, start=None, end=None, max_points=None,
+               aggregates=('mean', 'min', 'max')):
+        """
+        Return the fields (all when None) of a series between start and end. When the range holds more than
+        max_points rows it is downsampled on the server with GROUP BY time(), the first aggregate keeping the
+        field name and the others named <field>_<aggregate>.
+        """
+        if fields in (None, '*'):
+            fields = None
+        elif not isinstance(fields, (list, tuple)):
+            fields = [fields]
+
+        bucket = None
+        if max_points:
+            bucket, start, end = self.get_bucket(series_name, start, end, max_points)
+
+        where = _time_filter(start, end)
+
+        if bucket:
+            selects = []
+            for field in fields or self.get_field_keys(series_name):
+                for i, aggregate in enumerate(aggregates):
+                    alias = field if i == 0 else '%s_%s' % (field, aggregate)
+                    selects.append('%s(\"%s\") as \"%s\"' % (aggregate, field, alias))
+            q = 'select %s from %s%s group by time(%is) fill(none);' % (', '.join(selects), _quote(series_name), where,
+                                                                         bucket)
+        else:
+            select = '*' if fields is None else ', '.join('\"%s\"' % field for field in fields)
+            q = 'select %s from %s%s order by time asc;' % (select, _quote(series_name), where)
         result = self.influxdb.query(q)
+        if series_name not in result:
+            return pd.DataFrame(columns=fields or [], index=pd.DatetimeIndex([], tz='UTC'))
         return result[series_name]
 
+    def get_bucket(self, series_name, start=None, end=None, max_points=1000):
+        """
+        Return (bucket seconds, start, end) for reading at most max_points rows of a series, bucket is None when
+        the range is small enough to read as is. An open start is resolved to the first timestamp, an open end to
+        now rather than the cached watermark, which a process that only reads never advances.
+        """
+        where = _time_filter(start, end)
+        result = self.influxdb.query('select count(*) from %s%s;' % (_quote(series_name), where))
+        if series_name not in result or result[series_name].empty:
+            return None, start, end
+        count = result[series_name].max(axis=1).iloc[0]
+        if count <= max_points:
+            return None, start, end
+
+        if start is None:
+            start = self.check_ts(series_name)
+        if end is None:
+            end = pd.Timestamp.now(tz='UTC')
+        bucket = max(1, int(np.ceil(float(_epoch(end) - _epoch(start)) / max_points)))
+        return bucket, start, end
+
+    def get_grid(self, series_names, start=None, end=None, max_points=1000, min_bucket=1):
+        """
+        Return (bucket seconds, start, end) of a time grid shared by several series, with at most max_points
+        buckets of at least min_bucket seconds. bucket is 0 when none of the series has more than max_points rows
+        in the range, so they can be read as is, and None when none of them has data there. An open start of a
+        grid is resolved to the earliest first timestamp of the series, an open end to now.
+        """
+        names = ','.join(_quote(name) for name in series_names)
+        result = self.influxdb.query('select count(*) from %s%s;' % (names, _time_filter(start, end)))
+        counts = [result[name].max(axis=1).iloc[0] for name in series_names if name in result and not result[name].empty]
+        if not counts:
+            return None, start, end
+        if max(counts) <= max_points:
+            return 0, start, end
+
+        if start is None:
+            result = self.influxdb.query('select * from %s order by time asc limit 1;' % names)
+            start = min(result[name].index[0] for name in series_names if name in result and not result[name].empty)
+        if end is None:
+            end = pd.Timestamp.now(tz='UTC')
+        bucket = max(min_bucket, int(np.ceil(float(_epoch(end) - _epoch(start)) / max_points)))
+        return bucket, start, end
+
+    def get_multi_ts(self, series_fields, start=None, end=None, max_points=1000, bucket=None, min_bucket=1,
+                     aggregates=('mean',)):
+        """
+        Read fields of several series in one query. series_fields is a list of (series, field) pairs, the result
+        has a column per pair. With a bucket of 0 the points are read as they are, indexed by the union of their
+        timestamps; otherwise they are resampled onto a shared grid of bucket seconds and indexed by the bucket
+        start, the first aggregate keeping the pair and the others added as (series, <field>_<aggregate>). When
+        bucket is None get_grid decides.
+        """
+        series_fields = [tuple(pair) for pair in series_fields]
+        columns = pd.MultiIndex.from_tuples(series_fields, names=['series', 'field']) if series_fields else None
+        empty = pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], tz='UTC'), dtype=np.float64)
+        if not series_fields:
+            return empty
+        series_names = sorted(set(series_name for series_name, _ in series_fields))
+        if bucket is None or (bucket and start is None):
+            grid, start, end = self.get_grid(series_names, start, end, max_points, min_bucket)
+            if grid is None:
+                return empty
+            # a range that fits in max_points is read as is even when a bucket was asked for
+            bucket = grid if bucket is None or not grid else bucket
+
+        fields = sorted(set(field for _, field in series_fields))
+        names = ','.join(_quote(name) for name in series_names)
+        if bucket:
+            # group by time() buckets start at multiples of the bucket since the epoch, so all series share them
+            selects = ', '.join('%s(\"%s\") as \"%s\"' % (aggregate, field,
+                                                            field if i == 0 else '%s_%s' % (field, aggregate))
+                                for field in fields for i, aggregate in enumerate(aggregates))
+            q = 'select %s from %s%s group by time(%is) fill(none);' % (selects, names, _time_filter(start, end), bucket)
+            series_fields = series_fields + [(series_name, '%s_%s' % (field, aggregate))
+                                             for series_name, field in series_fields for aggregate in aggregates[1:]]
+            columns = pd.MultiIndex.from_tuples(series_fields, names=['series', 'field'])
+        else:
+            selects = ', '.join('\"%s\"' % field for field in fields)
+            q = 'select %s from %s%s order by time asc;' % (selects, names, _time_filter(start, end))
+        result = self.influxdb.query(q)
+
+        found = [pair for pair in series_fields if pair[0] in result and pair[1] in result[pair[0]]]
+        if not found:
+            return empty
+        found_names = sorted(set(series_name for series_name, _ in found))
+        index = result[found_names[0]].index
+        for series_name in found_names[1:]:
+            index = index.union(result[series_name].index)
+        df = pd.DataFrame(dict((pair, result[pair[0]][pair[1]].reindex(index).values) for pair in found), index=index)
+        return df.reindex(columns=columns).astype(np.float64)
+
+    def get_field_keys(self, series_name):
+        # DataFrameClient only shapes time series, so ask the plain client
+        result = InfluxDBClient.query(self.influxdb, 'show field keys from %s;' % _quote(series_name))
+        return [point['fieldKey'] for point in result.get_points()]
+
+    def get_all_field_keys(self, numeric_only=True):
+        """
+        Return {series name: [field keys]} of every series in the database, read in one query
+        """
+        result = InfluxDBClient.query(self.influxdb, 'show field keys;')
+        fields = {}
+        for (series_name, _), points in result.items():
+            fields[series_name] = [point['fieldKey'] for point in points
+                                   if not numeric_only or point.get('fieldType', 'float') in ('float', 'integer')]
+        return fields
+
     def get_last_timestamp(self, series_name, prop='*'):
-        q = 'select %s from \"%s\" order by time desc limit 1;' % (prop, series_name)
+        if prop == '*':
+            return self.get_last_timestamps([series_name])[series_name]
+        q = 'select %s from %s order by time desc limit 1;' % (prop, _quote(series_name))
         result = self.influxdb.query(q)
         return result[series_name].index[0]
 
-    def write_ts(self, series_name, df):
+    def get_last_timestamps(self, series_names, chunk_size=100):
+        """
+        Return {series_name: last timestamp} for those of series_names that have data. Cached watermarks are used
+        where available, the rest is resolved with one query per chunk_size series. Series found empty are cached
+        as such too, until points of them are written or the TTL runs out.
+        """
+        now = time.time()
+        with self._lock:
+            cached = dict((name, self._watermarks[name][0]) for name in series_names
+                          if name in self._watermarks and now - self._watermarks[name][1] < self.watermark_ttl)
+        watermarks = dict((name, timestamp) for name, timestamp in cached.items() if timestamp is not None)
+        missing = [name for name in series_names if name not in cached]
+        for i in range(0, len(missing), chunk_size):
+            names = missing[i:i + chunk_size]
+            # limit applies per series, so this returns the last row of each of them
+            q = 'select * from %s order by time desc limit 1;' % ','.join(_quote(name) for name in names)
+            result = self.influxdb.query(q)
+            for name in names:
+                if name in result and not result[name].empty:
+                    watermarks[name] = self.advance_watermark(name, result[name].index[0])
+                else:
+                    with self._lock:
+                        current = self._watermarks.get(name)
+                        if current is None or now - current[1] >= self.watermark_ttl:
+                            self._watermarks[name] = (None, now)
+        return watermarks
+
+    def advance_watermark(self, series_name, timestamp):
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize('UTC')
+        now = time.time()
+        with self._lock:
+            current = self._watermarks.get(series_name)
+            # an expired watermark is replaced, the server may have gone back e.g. after a drop by another process;
+            # so is the marker of a series found empty
+            if (current is None or current[0] is None or now - current[1] >= self.watermark_ttl or
+                    timestamp >= current[0]):
+                self._watermarks[series_name] = (timestamp, now)
+            return self._watermarks[series_name][0]
+
+    def invalidate_watermarks(self, series_names=None):
+        with self._lock:
+            if series_names is None:
+                self._watermarks.clear()
+            for name in series_names or []:
+                self._watermarks.pop(name, None)
+
+    def add_write_listener(self, callback):
+        """
+        Call callback(series_name) after points of a series have been written, e.g. QueryCache.invalidate. Adding
+        a callback again has no effect.
+        """
+        with self._lock:
+            if callback not in self._write_listeners:
+                self._write_listeners.append(callback)
+
+    def _written(self, series_name, timestamp):
+        self.advance_watermark(series_name, timestamp)
+        for callback in self._write_listeners:
+            try:
+                callback(series_name)
+            except Exception as e:
+                print('Write listener failed for %s: %s' % (series_name, e))
+
+    def write_ts(self, series_name, df, tags=None):
+        if self.batch_points:
+            return self._enqueue(series_name, df, tags)
         try:
-            return self.influxdb.write_points(df, series_name)
+            self.write_lines(encode_lines(series_name, df, tags, self.precision))
         except InfluxDBClientError, e:
             print 'Writing error of InfluxDB '
+            return
+        if len(df):
+            self._written(series_name, df.index.max())
+        return True
+
+    def write_lines(self, lines):
+        if not lines:
+            return
+        body = '\n'.join(lines)
+        if isinstance(body, text_type):
+            body = body.encode('utf-8')
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        session = get_session('influxdb', pool_maxsize=self.pool_size or 10)
+        r = session.post(self._write_url, params=self._write_params, data=body, headers=headers,
+                         timeout=self.timeout, verify=self._write_verify)
+        if r.status_code != 204:
+            raise InfluxDBClientError(r.text, r.status_code)
+
+    def flush(self):
+        """
+        Block until every frame queued so far has been written
+        """
+        with self._cond:
+            if self._writer is None:
+                return
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._buffer or self._flushing:
+                self._start_writer()
+                self._cond.wait(self.flush_interval)
+
+    def close(self):
+        """
+        Write the queued frames and stop the background writer
+        """
+        with self._cond:
+            self._closed = True
+            if self._buffer:
+                self._start_writer()
+            self._cond.notify_all()
+            writer = self._writer
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
+
+    def _enqueue(self, series_name, df, tags=None):
+        if not len(df):
+            return True
+        with self._cond:
+            while self._pending_points >= self.max_buffered_points and not self._closed:
+                self._start_writer()
+                self._cond.wait(self.flush_interval)
+            if self._closed:
+                raise ValueError('write buffer of InfluxTSDB is closed')
+            if self._writer is None:
+                atexit.register(self.close)
+            self._start_writer()
+            self._buffer.append((series_name, df, tags))
+            self._queued_points += len(df)
+            self._pending_points += len(df)
+            if self._queued_points >= self.batch_points:
+                self._cond.notify_all()
+        return True
+
+    def _start_writer(self):
+        # called with _cond held; a writer that died is replaced, so the queued frames are not stranded
+        if self._writer is None or not self._writer.is_alive():
+            if self._writer is not None:
+                print('The InfluxDB writer thread has stopped, starting a new one')
+            self._writer = threading.Thread(target=self._write_loop, name='influxtsdb-writer')
+            self._writer.daemon = True
+            self._writer.start()
 
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.flush_interval
+                while not (self._closed or self._flush_requested or self._queued_points >= self.batch_points):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._buffer = self._buffer, []
+                self._queued_points = 0
+                self._flushing = True
+            try:
+                self._write_batch(batch)
+            finally:
+                with self._cond:
+                    self._flushing = False
+                    self._pending_points -= sum(len(df) for _, df, _ in batch)
+                    if not self._buffer:
+                        self._flush_requested = False
+                    self._cond.notify_all()
+                    if self._closed and not self._buffer:
+                        return
 
+    def _write_batch(self, batch):
+        # frames of several series go out together, in bodies of at most batch_points lines
+        i = 0
+        while i < len(batch):
+            lines, watermarks, points = [], [], 0
+            while i < len(batch) and (points == 0 or points + len(batch[i][1]) <= self.batch_points):
+                series_name, df, tags = batch[i]
+                i += 1
+                points += len(df)
+                try:
+                    lines.extend(encode_lines(series_name, df, tags, self.precision))
+                    watermarks.append((series_name, df.index.max()))
+                except Exception as e:
+                    # a frame that cannot be encoded is dropped on its own, the others are still written
+                    print('Encoding error for %s, dropped %i points: %s' % (series_name, len(df), e))
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.write_lines(lines)
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        print('Writing error of InfluxDB, dropped %i points: %s' % (len(lines), e))
+                        break
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                else:
+                    for series_name, timestamp in watermarks:
+                        self._written(series_name, timestamp)
+                    break
@@ -0,0 +1,31 @@
+# coding: utf-8
+import numpy as np
+import pandas as pd
+
+
+def measure_arrays(body, ncols):
+    """
+    Turn a getMeasure body {epoch: [values]} into an ascending int64 epoch array and a float64 (rows, ncols)
+    value array. Rows with missing or non-numeric values are dropped.
+    """
+    if not body:
+        return np.empty(0, dtype=np.int64), np.empty((0, ncols), dtype=np.float64)
+
+    epochs = np.array(list(body.keys()), dtype=np.int64)
+    frame = pd.DataFrame(list(body.values())).reindex(columns=range(ncols))
+    values = frame.apply(pd.to_numeric, errors='coerce').values.astype(np.float64)
+
+    valid = ~np.isnan(values).any(axis=1)
+    epochs, values = epochs[valid], values[valid]
+    order = np.argsort(epochs, kind='mergesort')
+    return epochs[order], values[order]
+
+
+def measure_frame(body, cols):
+    """
+    Turn a getMeasure body into a frame with a column per measure type, indexed by the UTC time of the readings
+    """
+    epochs, values = measure_arrays(body, len(cols))
+    index = pd.to_datetime(epochs, unit='s')
+    index.name = "time"
+    return pd.DataFrame(values, index=index, columns=cols)
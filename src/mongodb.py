@@ -1,20 +1,105 @@
 #!/usr/bin/env python
 # encoding: utf-8
 # Create your views here.
-from pymongo import MongoClient
+import base64
+import copy
+
+from pymongo import MongoClient, ReplaceOne, UpdateOne
 import pymongo
-import json
 from bson import BSON
 from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+
+from querycache import QueryCache
+
+try:
+    _SCALARS = (basestring, int, long, float, bool)
+except NameError:
+    _SCALARS = (str, bytes, int, float, bool)
+
+# keys renamed in the documents handed out, as the JSON round trip used to
+_RENAMED_KEYS = {'_id': 'uid', '$oid': 'id'}
+
+
+def shape_document(value):
+    """
+    Return a document with _id keys renamed to uid, ObjectIds as {'id': hex} and the other BSON types in their
+    extended JSON form. Only whole keys are renamed, fields like box_id are left alone.
+    """
+    if isinstance(value, dict):
+        shaped = {}
+        for key, item in value.items():
+            # scalars, the bulk of most documents, are copied without a call
+            if item is not None and not isinstance(item, _SCALARS):
+                item = shape_document(item)
+            shaped[_RENAMED_KEYS.get(key, key)] = item
+        return shaped
+    if isinstance(value, (list, tuple)):
+        return [item if item is None or isinstance(item, _SCALARS) else shape_document(item) for item in value]
+    if value is None or isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, ObjectId):
+        return {'id': str(value)}
+    return shape_document(json_util.default(value))
+
+
+def shape_documents(cursor):
+    for doc in cursor:
+        yield shape_document(doc)
+
+
+def _field(doc, path):
+    for key in path.split('.'):
+        try:
+            doc = doc[key]
+        except (KeyError, TypeError):
+            return None
+    return doc
+
+
+def _encode_after(value, last_id):
+    return base64.urlsafe_b64encode(BSON.encode({'v': value, 'id': last_id})).decode('ascii')
+
+
+def _decode_after(after):
+    position = BSON(base64.urlsafe_b64decode(str(after))).decode()
+    return position['v'], position['id']
 
 
 class MongoConnection():
-    def __init__ (self, host="localhost", port=27017, db_name='scadb', username='sca', password='Abcd1234'):
+    def __init__ (self, host="localhost", port=27017, db_name='scadb', username='sca', password='Abcd1234',
+                  cache_size=0, cache_ttl=60, max_pool_size=100):
         self.host = host
         self.port = port
-        self.conn = MongoClient(self.host, self.port)
+        # MongoClient is thread safe and keeps up to max_pool_size connections per server
+        self.conn = MongoClient(self.host, self.port, maxPoolSize=max_pool_size)
         self.db = self.conn[db_name]
         self.db.authenticate(username, password)
+        # with cache_size > 0, get_one and get_all read through an LRU cache of that many results, kept for
+        # cache_ttl seconds and dropped per collection by the writes of this class
+        self.cache = QueryCache(maxsize=cache_size, ttl=cache_ttl) if cache_size else None
+
+    def cache_stats(self):
+        if self.cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0}
+        return self.cache.stats()
+
+    def invalidate(self, table_name=None):
+        """
+        Drop the cached results of a collection, or of all collections when table_name is None
+        """
+        if self.cache is not None:
+            self.cache.invalidate(table_name)
+
+    def _cached(self, table_name, key, loader):
+        if self.cache is None:
+            return loader()
+        # callers get a copy, so changing a result does not change the cached one
+        key = (table_name,) + tuple(json_util.dumps(part, sort_keys=True) for part in key)
+        return copy.deepcopy(self.cache.get_or_load(table_name, key, loader))
 
     def ensure_index(self, table_name, index=None):
         self.db[table_name].ensure_index([(index,pymongo.GEOSPHERE)])
@@ -24,71 +109,138 @@ class MongoConnection():
 
     def drop_table(self, table_name):
         self.db.drop_collection(table_name)
+        self.invalidate(table_name)
 
-    def get_one(self, table_name, conditions={}):
-        single_doc = self.db[table_name].find_one(conditions)
-        json_doc = json.dumps(single_doc,default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(json_doc)
+    def collection(self, table_name, raw=False):
+        """
+        The collection of table_name. With raw, documents come back as RawBSONDocuments that keep the BSON
+        undecoded and decode a field only when it is read, for callers that need neither renaming nor every field
+        """
+        if raw:
+            return self.db.get_collection(table_name, codec_options=CodecOptions(document_class=RawBSONDocument))
+        return self.db[table_name]
 
-    def get_all(self, table_name, conditions={}, sort_index ='_id', limit=100):
-        all_doc = self.db[table_name].find(conditions).sort(sort_index, pymongo.DESCENDING).limit(limit)
-        json_doc = json.dumps(list(all_doc),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(str(json_doc))
+    def get_one(self, table_name, conditions={}, raw=False):
+        if raw:
+            return self.collection(table_name, raw).find_one(conditions)
+        return self._cached(table_name, ('one', conditions),
+                            lambda: shape_document(self.db[table_name].find_one(conditions)))
+
+    def get_all(self, table_name, conditions={}, sort_index ='_id', limit=100, raw=False):
+        if raw:
+            return list(self.collection(table_name, raw).find(conditions).sort(sort_index, pymongo.DESCENDING).limit(limit))
+        return self._cached(table_name, ('all', conditions, sort_index, limit), lambda: list(shape_documents(
+            self.db[table_name].find(conditions).sort(sort_index, pymongo.DESCENDING).limit(limit))))
 
     def delete(self, table_name, conditions={}):
         self.db[table_name].remove(conditions)
+        self.invalidate(table_name)
 
     def insert_one(self, table_name, value):
         self.db[table_name].insert(value)
+        self.invalidate(table_name)
 
     def update_push(self, table_name, where, what):
         #print where, what
         self.db[table_name].update(where,{"$push":what}, upsert=False)
+        self.invalidate(table_name)
 
     def update(self, table_name, where, what):
         #print where, what
         self.db[table_name].update(where,{"$set":what}, upsert=False)
+        self.invalidate(table_name)
 
     def update_multi(self, table_name, where, what):
         self.db[table_name].update(where,{"$set":what}, upsert=False, multi=True)
+        self.invalidate(table_name)
 
     def update_upsert(self, table_name, where, what):
         self.db[table_name].update(where,{"$set":what}, upsert=True)
+        self.invalidate(table_name)
+
+    def bulk_upsert(self, table_name, docs, key, replace=True):
+        """
+        Insert or update docs by the value of key (a field name or a list of them) in one unordered bulk write.
+        Matched documents are replaced, or only have the given fields set when replace is False. Returns the
+        counts of matched, inserted and modified documents.
+        """
+        keys = key if isinstance(key, (list, tuple)) else [key]
+        operations = []
+        for doc in docs:
+            where = dict((k, doc[k]) for k in keys)
+            if replace:
+                operations.append(ReplaceOne(where, doc, upsert=True))
+            else:
+                operations.append(UpdateOne(where, {"$set": doc}, upsert=True))
+        if not operations:
+            return {'matched': 0, 'inserted': 0, 'modified': 0}
+        try:
+            result = self.db[table_name].bulk_write(operations, ordered=False)
+        finally:
+            # an unordered bulk write may have been applied in part when it fails
+            self.invalidate(table_name)
+        return {'matched': result.matched_count, 'inserted': result.upserted_count,
+                'modified': result.modified_count}
 
 
     def map_reduce(self, table_name, mapper, reducer, query, result_table_name):
         myresult = self.db[table_name].map_reduce(mapper, reducer, result_table_name, query)
         return myresult
 
-    def map_reduce_search(self, table_name, mapper, reducer,query, sort_by, sort = -1, limit = 20):
-        if sort_by == "distance":
-            sort_direction = pymongo.ASCENDING
+    def aggregate(self, table_name, pipeline, batch_size=1000, raw=False):
+        """
+        Yield the results of an aggregation pipeline straight from its cursor, batch_size documents per round trip
+        """
+        cursor = self.collection(table_name, raw).aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+        for doc in cursor:
+            yield doc if raw else shape_document(doc)
+
+    def search(self, table_name, query={}, sort_by=None, sort=-1, limit=20, near=None, max_distance=None,
+               location_field=None, pipeline=None):
+        """
+        Return the documents matching query, run through the extra pipeline stages and sorted by sort_by, or nearest
+        first when near, a (longitude, latitude) pair or GeoJSON point, is given. The distance in meters is then
+        added as the distance field; location_field picks the GEOSPHERE index when the collection has several.
+        """
+        if near is not None:
+            if isinstance(near, (list, tuple)):
+                near = {'type': 'Point', 'coordinates': list(near)}
+            geo_near = {'near': near, 'distanceField': 'distance', 'spherical': True, 'query': query}
+            if max_distance is not None:
+                geo_near['maxDistance'] = max_distance
+            if location_field is not None:
+                geo_near['key'] = location_field
+            stages = [{'$geoNear': geo_near}]
         else:
-            sort_direction = pymongo.DESCENDING
-        myresult = self.db[table_name].map_reduce(mapper,reducer,'results', query)
-        results = self.db['results'].find().sort("value."+sort_by, sort_direction).limit(limit)
-        json_doc = json.dumps(list(results),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(str(json_doc))
-
-    def aggregrate_all(self, table_name, conditions={}):
-        all_doc = self.db[table_name].aggregate(conditions)['result']
-        json_doc = json.dumps(list(all_doc),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(str(json_doc))
-
-    def group(self, table_name, key, condition, initial, reducer):
-        all_doc = self.db[table_name].group(key=key, condition=condition, initial=initial, reduce=reducer)
-        json_doc = json.dumps(list(all_doc),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(str(json_doc))
+            stages = [{'$match': query}]
+        stages.extend(pipeline or [])
+        if sort_by is not None and not (near is not None and sort_by == 'distance'):
+            stages.append({'$sort': {sort_by: sort}})
+        stages.append({'$limit': limit})
+        return list(self.aggregate(table_name, stages))
+
+    def aggregrate_all(self, table_name, conditions=[]):
+        return list(self.aggregate(table_name, conditions))
+
+    def group(self, table_name, key, condition={}, accumulators=None, sort=None, limit=None):
+        """
+        Group the documents matching condition by key, a field name or a list of them, on the server. accumulators
+        maps output fields to $group accumulators and defaults to a count. Each result holds the key fields and
+        the accumulated ones, sort ([(field, direction)] as for find) and limit are applied on the server as well.
+        """
+        keys = key if isinstance(key, (list, tuple)) else [key]
+        accumulators = accumulators or {'count': {'$sum': 1}}
+        group = {'_id': dict((k, '$' + k) for k in keys)}
+        group.update(accumulators)
+        project = {'_id': 0}
+        project.update((k, '$_id.' + k) for k in keys)
+        project.update((field, 1) for field in accumulators)
+        stages = [{'$match': condition}, {'$group': group}, {'$project': project}]
+        if sort:
+            stages.append({'$sort': SON(sort)})
+        if limit:
+            stages.append({'$limit': limit})
+        return list(self.aggregate(table_name, stages))
 
     def get_distinct(self, table_name, distinct_val, query):
         all_doc = self.db[table_name].find(query).distinct(distinct_val)
@@ -98,19 +250,50 @@ class MongoConnection():
         parameter['results'] = all_doc
         return parameter
 
-    def get_all_vals(self, table_name, conditions={}, sort_index ='_id'):
-        all_doc = self.db[table_name].find(conditions).sort(sort_index, pymongo.DESCENDING)
-        json_doc = json.dumps(list(all_doc),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(json_doc)
-
-    def get_paginated_values(self, table_name, conditions ={}, sort_index ='_id', pageNumber = 1):
-        all_doc = self.db[table_name].find(conditions).sort(sort_index, pymongo.DESCENDING).skip((pageNumber-1)*15).limit(15)
-        json_doc = json.dumps(list(all_doc),default=json_util.default)
-        json_doc = json_doc.replace("$oid", "id")
-        json_doc = json_doc.replace("_id", "uid")
-        return json.loads(json_doc)
+    def get_all_vals(self, table_name, conditions={}, sort_index ='_id', raw=False):
+        return list(self.iter_all(table_name, conditions, sort_index, raw=raw))
+
+    def iter_all(self, table_name, conditions={}, sort_index='_id', batch_size=1000, raw=False):
+        """
+        Yield the matching documents in descending sort_index order, read from the server batch_size at a time so
+        only one batch is held in memory
+        """
+        cursor = self.collection(table_name, raw).find(conditions).sort(sort_index, pymongo.DESCENDING)
+        for doc in cursor.batch_size(batch_size):
+            yield doc if raw else shape_document(doc)
+
+    def get_page(self, table_name, conditions={}, sort_index='_id', after=None, page_size=15, raw=False):
+        """
+        Return (documents, after) for a page of at most page_size documents in descending sort_index order, where
+        after is an opaque token for the next page, None after the last one. A page starts right after the last
+        document of the previous one instead of skipping over the pages before it, so every page costs the same.
+        """
+        query = conditions
+        if after is not None:
+            value, last_id = _decode_after(after)
+            if sort_index == '_id':
+                position = {'_id': {'$lt': last_id}}
+            else:
+                position = {'$or': [{sort_index: {'$lt': value}}, {sort_index: value, '_id': {'$lt': last_id}}]}
+            query = {'$and': [conditions, position]} if conditions else position
+        sort = [(sort_index, pymongo.DESCENDING)]
+        if sort_index != '_id':
+            # _id breaks ties, so documents with the same sort value are neither repeated nor skipped
+            sort.append(('_id', pymongo.DESCENDING))
+
+        # one document more than asked for tells whether there is a next page
+        docs = list(self.collection(table_name, raw).find(query).sort(sort).limit(page_size + 1))
+        after = None
+        if len(docs) > page_size:
+            docs = docs[:page_size]
+            after = _encode_after(_field(docs[-1], sort_index), docs[-1]['_id'])
+        return (docs if raw else [shape_document(doc) for doc in docs]), after
+
+    def get_paginated_values(self, table_name, conditions ={}, sort_index ='_id', pageNumber = 1, raw=False,
+                             page_size=15):
+        # skips over all earlier pages, get_page does not
+        all_doc = self.collection(table_name, raw).find(conditions).sort(sort_index, pymongo.DESCENDING).skip((pageNumber-1)*page_size).limit(page_size)
+        return list(all_doc) if raw else list(shape_documents(all_doc))
 
     def get_count(self, table_name, conditions={}, sort_index='_id'):
         count = self.db[table_name].find(conditions).count()
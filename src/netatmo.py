@@ -3,14 +3,20 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 import pandas as pd
 import numpy as np
 import lnetatmo
+from httpsession import make_post_request
 from influxtsdb import InfluxTSDB
+from measure import measure_frame
 from lnetatmo import *
 
 import time
 from datetime import datetime
 
+
 class Netatmo:
     def __init__(self, clientId, clientSecret, user, password, verbose=True):
+        # route the lnetatmo calls through a pooled keep-alive session. lnetatmo has one postRequest per process,
+        # so this is done here rather than on import; the last collector created names the pool.
+        lnetatmo.postRequest = make_post_request('netatmo')
         self.devList = WeatherStationData(lnetatmo.ClientAuth(clientId, clientSecret, user, password))
         self.ts_name = 'netatmo.{}{}'
 
@@ -25,6 +31,7 @@ class Netatmo:
         return start
 
     def import_missing(self):
+        self.ts_db.get_last_timestamps(self.series_names())
         for station_id, station in self.devList.stations.items():
             station_name = station['station_name'].replace(' ', '_')
             ts = self.ts_name.format(station_name,'')
@@ -46,28 +53,17 @@ class Netatmo:
                 if not df.empty:
                     self.ts_db.write_ts(ts, df)
 
+    def series_names(self):
+        names = []
+        for station in self.devList.stations.values():
+            station_name = station['station_name'].replace(' ', '_')
+            names.append(self.ts_name.format(station_name, ''))
+            for module in station['modules']:
+                names.append(self.ts_name.format(station_name, '.' + module['module_name'].replace(' ', '_')))
+        return names
+
     def convert_to_df(self, json, cols):
-        numberOfRows = len(json['body'])
-        columns = ['readtime', ]
-        columns.extend(cols)
-        df = pd.DataFrame(index=np.arange(0, numberOfRows), columns=columns)
-        data = json['body'].items()
-        for i in np.arange(0, numberOfRows):
-            readtime, measures = data[i]
-            try:
-                measures = map(float, measures)
-            except:
-                continue
-            row = [int(readtime)]
-            row.extend(measures)
-            df.loc[i] = row
-
-        df.index = pd.to_datetime(df["readtime"], unit='s')
-        df.index.name = "time"
-        df = df.drop("readtime", 1)
-        df.sort_index(ascending=False, inplace=True)
-        df.dropna(axis=0, how='any', inplace=True)
-        return df
+        return measure_frame(json['body'], cols)
 
 
 if __name__ == '__main__':
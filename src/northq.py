@@ -3,7 +3,9 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 import pandas as pd
 import numpy as np
 import lnetatmo
+from httpsession import make_post_request
 from influxtsdb import InfluxTSDB
+from measure import measure_frame
 from lnetatmo import *
 
 import time
@@ -12,6 +14,8 @@ from datetime import datetime
 
 class Northq:
     def __init__(self, clientId, clientSecret, user, password, verbose=True):
+        # pooled lnetatmo calls, installed on creation rather than on import like in Netatmo
+        lnetatmo.postRequest = make_post_request('northq')
         self.devList = WeatherStationData(lnetatmo.ClientAuth(clientId, clientSecret, user, password))
 
     def set_timeseries_db(self, ts_db):
@@ -25,6 +29,7 @@ class Northq:
         return start
 
     def import_missing(self):
+        self.ts_db.get_last_timestamps(self.series_names())
         for station_id, station in self.devList.stations.items():
             ts_name_s = 'netatmo.' + station['station_name']
             ts_name_s = ts_name_s.replace(' ', '_')
@@ -49,28 +54,17 @@ class Northq:
                 print df
                 self.ts_db.write_ts(ts_name_m, df)
 
+    def series_names(self):
+        names = []
+        for station in self.devList.stations.values():
+            ts_name_s = 'netatmo.' + station['station_name']
+            names.append(ts_name_s.replace(' ', '_'))
+            for module in station['modules']:
+                names.append((ts_name_s + '.' + module['module_name']).replace(' ', '_'))
+        return names
+
     def convert_to_df(self, json, cols):
-        numberOfRows = len(json['body'])
-        columns = ['readtime', ]
-        columns.extend(cols)
-        df = pd.DataFrame(index=np.arange(0, numberOfRows), columns=columns)
-        data = json['body'].items()
-        for i in np.arange(0, numberOfRows):
-            readtime, measures = data[i]
-            try:
-                measures = map(float, measures)
-            except:
-                continue
-            row = [int(readtime)]
-            row.extend(measures)
-            df.loc[i] = row
-
-        df.index = pd.to_datetime(df["readtime"], unit='s')
-        df.index.name = "time"
-        df = df.drop("readtime", 1)
-        df.sort_index(ascending=False, inplace=True)
-        df.dropna(axis=0, how='any', inplace=True)
-        return df
+        return measure_frame(json['body'], cols)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+# coding: utf-8
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+_MISSING = object()
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def _text(name):
+    # 'ic-meter.5482' from a collector and u'ic-meter.5482' from a Dash callback are the same series
+    return name.decode('utf-8') if isinstance(name, bytes) else text_type(name)
+
+
+def _names(series):
+    return tuple(_text(name) for name in series) if isinstance(series, (list, tuple)) else (_text(series),)
+
+
+def _private_dir(path):
+    """
+    Create path readable by the current user only, returns False when it exists but is not, e.g. because another
+    user created it first
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        pass
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and
+            not info.st_mode & (stat.S_IRWXG | stat.S_IRWXO))
+
+
+class QueryCache:
+    """
+    TTL cache for query results with an in-process LRU tier and an optional directory shared by the worker
+    processes of a host. Entries are filed under the series (a name or a list of names) they were read from,
+    invalidate(series) drops them in every process using the same directory. The entries in the directory are
+    pickled, so it has to be private to the user running the processes; the shared tier is left out when it
+    is not.
+    """
+
+    def __init__(self, maxsize=256, ttl=60, shared_dir=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared_dir = shared_dir
+        if shared_dir and not _private_dir(shared_dir):
+            print('Not sharing the query cache, %s is not private to this user' % shared_dir)
+            self.shared_dir = None
+        self.hits = 0
+        self.misses = 0
+        # key -> (stored at, series, value)
+        self._entries = OrderedDict()
+        # series -> invalidated at, None for all series
+        self._invalidated = {}
+        self._lock = threading.Lock()
+        self._swept_at = 0
+
+    def get_or_load(self, series, key, loader):
+        value = self.get(series, key)
+        if value is _MISSING:
+            # stamped with the time the load started, so an invalidation during the load is not missed
+            loaded_at = time.time()
+            value = loader()
+            self.set(series, key, value, loaded_at)
+        return value
+
+    def get(self, series, key):
+        now = time.time()
+        invalidated = max([0] + [self._invalidated_at(name) for name in _names(series)])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl and entry[0] > invalidated:
+                    # most recently used entries live at the end
+                    self._entries[key] = self._entries.pop(key)
+                    self.hits += 1
+                    return entry[2]
+                del self._entries[key]
+
+        entry = self._read_shared(key)
+        if entry is not None and now - entry[0] < self.ttl and entry[0] > invalidated:
+            self._store(key, entry)
+            with self._lock:
+                self.hits += 1
+            return entry[2]
+
+        with self._lock:
+            self.misses += 1
+        return _MISSING
+
+    def set(self, series, key, value, stored_at=None):
+        entry = (time.time() if stored_at is None else stored_at, _names(series), value)
+        self._store(key, entry)
+        if self.shared_dir:
+            fd, tmp = tempfile.mkstemp(dir=self.shared_dir, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, self._path(key))
+            except (OSError, IOError, pickle.PicklingError):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            self._sweep()
+
+    def invalidate(self, series=None):
+        """
+        Drop the entries of a series, or all entries when series is None
+        """
+        now = time.time()
+        if series is not None:
+            series = _text(series)
+        with self._lock:
+            self._invalidated[series] = now
+            for key in [k for k, entry in self._entries.items() if series is None or series in entry[1]]:
+                del self._entries[key]
+        if self.shared_dir:
+            with open(self._marker(series), 'w') as f:
+                f.write(repr(now))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _sweep(self):
+        """
+        Remove the files of the shared directory that are older than the TTL, at most once per TTL. Entries
+        and invalidations older than that can no longer make a difference.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._swept_at < self.ttl:
+                return
+            self._swept_at = now
+        try:
+            names = os.listdir(self.shared_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.shared_dir, name)
+            try:
+                if now - os.path.getmtime(path) >= self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _invalidated_at(self, series):
+        with self._lock:
+            invalidated = max(self._invalidated.get(series, 0), self._invalidated.get(None, 0))
+        if self.shared_dir:
+            for marker in (self._marker(series), self._marker(None)):
+                try:
+                    with open(marker) as f:
+                        invalidated = max(invalidated, float(f.read()))
+                except (IOError, OSError, ValueError):
+                    pass
+        return invalidated
+
+    def _read_shared(self, key):
+        if not self.shared_dir:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _path(self, key):
+        return os.path.join(self.shared_dir, _digest(key) + '.pickle')
+
+    def _marker(self, series):
+        if series is None:
+            return os.path.join(self.shared_dir, 'invalidated-all')
+        return os.path.join(self.shared_dir, 'invalidated-' + hashlib.sha1(_text(series).encode('utf-8')).hexdigest())
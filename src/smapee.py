@@ -1,10 +1,15 @@
 # coding: utf-8
 import datetime as dt
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import arrow
+import pandas as pd
 import smappy
 from postgres import Postgres
+from psycopg2.extras import execute_values
+
+_LOCAL_TZ = 'Europe/Copenhagen'
 
 
 class Smapee:
@@ -33,84 +38,114 @@ class Smapee:
             start = dt.datetime.utcnow() - dt.timedelta(days=365)
         return start
 
-
-
-    def import_5min_data(self):
+    def insert_consumption(self, table_name, df, daily=False, ignore_conflicts=True, page_size=1000):
+        """
+        Bulk insert a consumption dataframe from smappy with multi-row INSERTs in one transaction. Timestamps are
+        stored as local time, or as the UTC date for daily aggregates. With ignore_conflicts rows that already exist
+        are skipped, so an import can be rerun safely.
+        """
+        if df is None or df.empty:
+            return 0
+        df = df.reset_index()
+        timestamps = pd.to_datetime(df['timestamp'])
+        if timestamps.dt.tz is None:
+            timestamps = timestamps.dt.tz_localize('utc')
+        if daily:
+            timestamps = timestamps.dt.tz_convert('utc').dt.strftime('%Y-%m-%d')
+        else:
+            timestamps = timestamps.dt.tz_convert(_LOCAL_TZ).dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        rows = list(zip(timestamps.tolist(), [self.service_location_id] * len(df), df['alwaysOn'].tolist(),
+                        df['consumption'].tolist(), df['solar'].tolist()))
+        sql = 'INSERT INTO ' + table_name + ' VALUES %s'
+        if ignore_conflicts:
+            sql += ' ON CONFLICT DO NOTHING'
+        with self.db.get_cursor() as cursor:
+            execute_values(cursor, sql, rows, template='(%s::timestamp without time zone, %s, %s, %s, %s)',
+                           page_size=page_size)
+        return len(rows)
+
+    def import_5min_data(self, ignore_conflicts=True):
         try:
-            start = arrow.get(self.get_start_timestamp('smapee_elec_5min'), 'Europe/Copenhagen').to('utc').datetime + dt.timedelta(seconds=1)
+            start = arrow.get(self.get_start_timestamp('smapee_elec_5min'), _LOCAL_TZ).to('utc').datetime + dt.timedelta(seconds=1)
             end = dt.datetime.utcnow()
             print('Import every  5min:', start, '-', end)
             df = self.smapee.get_consumption_dataframe(self.service_location_id, start=start, end=end, aggregation=1)
-            df.reset_index(inplace=True)
-            for row in df.to_dict(orient='records'):
-                row['serviceid'] = self.service_location_id
-                row['timestamp'] = arrow.get(row['timestamp'], 'utc').to('Europe/Copenhagen').datetime
-                db.run('INSERT INTO smapee_elec_5min values(%(timestamp)s::timestamp without time zone, \
-                   %(serviceid)s, %(alwaysOn)s, %(consumption)s, %(solar)s)', row)
+            self.insert_consumption('smapee_elec_5min', df, ignore_conflicts=ignore_conflicts)
         except Exception as e:
             print(e)
 
-    def import_hourly_data(self):
+    def import_hourly_data(self, ignore_conflicts=True):
         try:
-            start = arrow.get(self.get_start_timestamp('smapee_elec_hourly'), 'Europe/Copenhagen').to('utc').datetime + dt.timedelta(hours=1)
+            start = arrow.get(self.get_start_timestamp('smapee_elec_hourly'), _LOCAL_TZ).to('utc').datetime + dt.timedelta(hours=1)
             end = dt.datetime.utcnow()
             print('Import hourly:', start, '-', end)
             df = self.smapee.get_consumption_dataframe(self.service_location_id, start=start, end=end, aggregation=2)
-            df.reset_index(inplace=True)
-            for row in df.to_dict(orient='records'):
-                row['serviceid'] = self.service_location_id
-                row['timestamp'] = arrow.get(row['timestamp'], 'utc').to('Europe/Copenhagen').datetime
-                db.run('INSERT INTO smapee_elec_hourly values(%(timestamp)s::timestamp without time zone, \
-                   %(serviceid)s, %(alwaysOn)s, %(consumption)s, %(solar)s)', row)
+            self.insert_consumption('smapee_elec_hourly', df, ignore_conflicts=ignore_conflicts)
         except Exception as e:
             print(e)
 
-    def import_daily_data(self):
+    def import_daily_data(self, ignore_conflicts=True):
         try:
             start = arrow.get(self.get_start_timestamp('smapee_elec_daily')).datetime + dt.timedelta(days=1)
             end = dt.datetime.utcnow()
             print('Import daily:', start, '-', end)
             df = self.smapee.get_consumption_dataframe(self.service_location_id, start=start, end=end, aggregation=3)
-            df.reset_index(inplace=True)
-            for row in df.to_dict(orient='records'):
-                row['serviceid'] = self.service_location_id
-                row['timestamp'] = arrow.get(row['timestamp']).format(fmt='YYYY-MM-DD')
-                db.run('INSERT INTO smapee_elec_daily values(%(timestamp)s::timestamp without time zone, \
-                   %(serviceid)s, %(alwaysOn)s, %(consumption)s, %(solar)s)', row)
+            self.insert_consumption('smapee_elec_daily', df, daily=True, ignore_conflicts=ignore_conflicts)
         except Exception as e:
             print(e)
 
 
-    def get_appliance_start_timestamp(self, serviceid, applianceid):
+    def get_appliance_start_timestamps(self, serviceid):
+        """
+        Return {applianceid: last imported timestamp} for all appliances of a service location in one query
+        """
         try:
-            start = self.db.one('SELECT max("timestamp") as last_time FROM smapee_appliance_reading WHERE serviceid=%(serviceid)s and applianceid=%(applianceid)s',
-                                {'serviceid':serviceid, 'applianceid':applianceid})
-            if start is None:
-                raise Exception
+            rows = self.db.all('SELECT applianceid, max("timestamp") as last_time FROM smapee_appliance_reading WHERE serviceid=%(serviceid)s GROUP BY applianceid',
+                               {'serviceid': serviceid}, back_as=dict)
         except Exception as e:
-            start = dt.datetime.utcnow() - dt.timedelta(days=365)
-        return start
-
-
-    def import_appliance_events(self):
+            rows = []
+        return dict((row['applianceid'], row['last_time']) for row in rows if row['last_time'] is not None)
+
+    def get_appliance_events(self, applianceId, name, start, end):
+        app_events = self.smapee.get_events(self.service_location_id, applianceId, start, end)
+        for event in app_events:
+            event['serviceId'] = self.service_location_id
+            event['applianceId'] = applianceId
+            event['name'] = name
+            event['timestamp'] = arrow.get(str(event['timestamp']/1000.0)).to(_LOCAL_TZ).datetime
+            if not 'totalPower' in event:
+                event['totalPower'] = None
+        return app_events
+
+    def insert_appliance_events(self, events, page_size=1000):
+        if not events:
+            return 0
+        with self.db.get_cursor() as cursor:
+            execute_values(cursor, 'INSERT INTO smapee_appliance_reading VALUES %s', events,
+                           template='(%(serviceId)s, %(applianceId)s, %(timestamp)s::timestamp without time zone, %(name)s, %(totalPower)s, %(activePower)s)',
+                           page_size=page_size)
+        return len(events)
+
+    def import_appliance_events(self, workers=4):
         SQL = "select cast(json_array_elements(info->'appliances')->>'id' as integer) as appliance_id, " \
               "json_array_elements(info->'appliances')->>'name' as name " \
               "from smapee_service_info where serviceid=%(serviceid)s order by 1"
         rows = self.db.all(SQL, {'serviceid': self.service_location_id},  back_as=dict)
         end = dt.datetime.utcnow()
-        for row in rows:
-            applianceId = row.get('appliance_id')
-            if applianceId:
-                start = arrow.get(self.get_appliance_start_timestamp(self.service_location_id, applianceId), 'Europe/Copenhagen').to('utc').datetime + dt.timedelta(seconds=1)
-                app_events = self.smapee.get_events(self.service_location_id, applianceId, start, end)
-                for event in app_events:
-                    event['serviceId'] = self.service_location_id
-                    event['applianceId'] = applianceId
-                    event['name'] = row.get('name')
-                    event['timestamp'] = arrow.get(str(event['timestamp']/1000.0)).to('Europe/Copenhagen').datetime
-                    if not 'totalPower' in event:
-                        event['totalPower'] = None
-                    self.db.run("INSERT INTO smapee_appliance_reading VALUES(%(serviceId)s, %(applianceId)s, %(timestamp)s::timestamp without time zone, %(name)s, %(totalPower)s, %(activePower)s)", event)
+        default_start = end - dt.timedelta(days=365)
+        watermarks = self.get_appliance_start_timestamps(self.service_location_id)
+
+        # fetch the appliances concurrently, then write all events of the account in one transaction
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for row in rows:
+                applianceId = row.get('appliance_id')
+                if applianceId:
+                    start = arrow.get(watermarks.get(applianceId, default_start), _LOCAL_TZ).to('utc').datetime + dt.timedelta(seconds=1)
+                    futures.append(executor.submit(self.get_appliance_events, applianceId, row.get('name'), start, end))
+            events = [event for future in futures for event in future.result()]
+        self.insert_appliance_events(events)
 
 
 if __name__ == '__main__':
@@ -3,10 +3,12 @@ import json
 from decimal import Decimal
 import logging
 import pytz
-import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
 from mongodb import MongoConnection
 
 import numpy as np
@@ -15,6 +17,7 @@ import requests
 from apscheduler.schedulers.blocking import BlockingScheduler
 from lnetatmo import *
 
+from httpsession import new_session
 from influxtsdb import InfluxTSDB
 
 logging.basicConfig(level=logging.INFO)
@@ -34,49 +37,84 @@ _HEADERS = {
 
 _DECIMALS = 1
 
+# status codes of calls rejected because the session cookie is no longer valid
+_AUTH_ERRORS = (401, 403)
 
-class ClientAuth:
+# seconds a latest reading is shared between callers
+_LATEST_MAX_AGE = 5
+
+# columns of the GetTempCSV download, which starts with a UTF-8 BOM:
+# Date/Time,Temperature (C),Moisture (%),Battery (Volts)
+_LOG_COLUMNS = ['readtime', 'temperature', 'moisture', 'battery']
+_LOG_CHUNKSIZE = 10000
+
+
+def parse_log_csv(stream, chunksize=_LOG_CHUNKSIZE):
     """
-    Request authentication and return authentication cookie. If cookie requested and not already logged in, it will log in again.
+    Parse a temperature log CSV from a file-like object and yield typed frames of at most chunksize rows
     """
+    reader = pd.read_csv(stream, header=0, names=_LOG_COLUMNS, encoding='utf-8-sig', chunksize=chunksize,
+                         dtype={'readtime': str})
+    for chunk in reader:
+        # columns are already float64 unless a malformed row slipped in
+        for col in _LOG_COLUMNS[1:]:
+            chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+        chunk.dropna(axis=0, how='any', inplace=True)
+        if chunk.empty:
+            continue
+        # keep the wall clock time of the tag, the UTC offset is ignored
+        index = pd.to_datetime(chunk['readtime'].str.slice(0, 19), format='%Y-%m-%dT%H:%M:%S')
+        df = chunk.drop('readtime', axis=1)
+        df.index = pd.DatetimeIndex(index, name='readtime')
+        yield df
 
-    def __init__(self, username, password):
 
-        postParams = {
-            "email": username,
-            "password": password
-        }
+class ClientAuth:
+    """
+    Sign in once and cache the authentication cookie. The cookie is renewed when it expires, or through relogin()
+    when a call is rejected as not signed in.
+    """
 
-        r = requests.post(_SIGNIN, headers=_HEADERS, data=json.dumps(postParams))
-        self._accessCookie = r.cookies
+    def __init__(self, username, password, session=None, session_ttl=60 * 60 * 12):
+        # a cookie jar per account, on the connection pool shared by all of them
+        self.session = session or new_session('wirelesstag')
         self._username = username
         self._password = password
+        self._session_ttl = session_ttl
+        self._lock = threading.Lock()
+        self.relogin()
 
-        r = requests.post(_ISSIGNED, headers=_HEADERS, cookies=self._accessCookie)
+        r = self.session.post(_ISSIGNED, headers=_HEADERS, cookies=self._accessCookie)
         response = r.json()
         if response['d'] != True:
             raise ValueError('Incorrect Login operation')
 
-    @property
-    def accessCookie(self):
-        # if not signed in, sign in and return cookie
-
-        r = requests.post(_ISSIGNED, headers=_HEADERS)
-        response = r.json()
-        if response['d'] == 'TRUE':
-            return self._accessCookie
-        else:
-            postParams = {
-                "email": self._username,
-                "password": self._password
-            }
-
-            r = requests.post(_SIGNIN, headers=_HEADERS, data=json.dumps(postParams))
+    def relogin(self, failed=None):
+        """
+        Sign in again and return the new cookie. Given the cookie a call failed with, threads that fail together
+        sign in once: the others get the cookie renewed in the meantime.
+        """
+        postParams = {
+            "email": self._username,
+            "password": self._password
+        }
 
+        with self._lock:
+            if failed is not None and self._accessCookie is not failed:
+                return self._accessCookie
+            r = self.session.post(_SIGNIN, headers=_HEADERS, data=json.dumps(postParams))
             self._accessCookie = r.cookies
+            # renew before the first cookie runs out, or after session_ttl for session cookies
+            expires = [cookie.expires for cookie in r.cookies if cookie.expires]
+            self._expires = min(expires + [time.time() + self._session_ttl])
             return self._accessCookie
 
-        return self._accessCookie
+    @property
+    def accessCookie(self):
+        cookie = self._accessCookie
+        if time.time() >= self._expires:
+            return self.relogin(cookie)
+        return cookie
 
 
 class WirelessTagData:
@@ -84,17 +122,48 @@ class WirelessTagData:
     Retrieves data from Wireless senors available
     """
 
-    def __init__(self, authData):
-        self.getAuthToken = authData.accessCookie
+    def __init__(self, authData, tag_list_ttl=300, workers=4):
+        self.auth = authData
+        self.session = authData.session
+        self.tag_list_ttl = tag_list_ttl
+        self._tagList = None
+        self._tagListTime = 0
+        self._tagListLock = threading.Lock()
+        # uuid -> (request time, future of the latest reading)
+        self._latest = {}
+        self._latestLock = threading.Lock()
+        # readings fetched concurrently by get_latest
+        self.workers = workers
 
-    #   self._TagList = self.getTagsList()
+    @property
+    def getAuthToken(self):
+        return self.auth.accessCookie
 
+    def post(self, url, data=None):
+        """
+        POST with the cached cookie, signing in again once if the call is rejected as not signed in
+        """
+        cookie = self.auth.accessCookie
+        r = self.session.post(url, headers=_HEADERS, cookies=cookie, data=data)
+        if r.status_code in _AUTH_ERRORS:
+            r = self.session.post(url, headers=_HEADERS, cookies=self.auth.relogin(cookie), data=data)
+        return r
 
     @property
     def tagList(self):
-        self._tagList = {}
-        cookies = self.getAuthToken
-        r = requests.post(_GETTAGLIST, headers=_HEADERS, cookies=cookies)
+        """
+        Tags of the account, fetched at most once every tag_list_ttl seconds
+        """
+        if self._tagList is None or time.time() - self._tagListTime > self.tag_list_ttl:
+            with self._tagListLock:
+                # readers that found the list stale together fetch it once
+                if self._tagList is None or time.time() - self._tagListTime > self.tag_list_ttl:
+                    self.refreshTagList()
+        return self._tagList
+
+    def refreshTagList(self):
+        tagList = {}
+        r = self.post(_GETTAGLIST)
 
         response = r.json()
         for i in response:
@@ -104,13 +173,15 @@ class WirelessTagData:
                 tag_name = tag["name"]
                 tag_type = tag["tagType"]
 
-                self._tagList[tag_uuid] = {'tag_id': tag_id, 'tag_name': tag_name, 'tag_type': tag_type}
+                tagList[tag_uuid] = {'tag_id': tag_id, 'tag_name': tag_name, 'tag_type': tag_type}
 
+        self._tagList = tagList
+        self._tagListTime = time.time()
         return self._tagList
 
     def getLogInRange(self, uuid="", fromDate='', toDate=''):
         url = _GETTEMPCSV + '?uuid={}&fromdate={}&todate={}'.format(uuid, fromDate, toDate)
-        res = requests.get(url)
+        res = self.session.get(url)
         if res.status_code==200:
             # ['\xef\xbb\xbfDate/Time,Temperature (C),Moisture (%),Battery (Volts)', '2017-11-29T07:02:27+01:00,14.626259803772,70.1337280273438,2.8763861656189','']
             return res.content
@@ -127,21 +198,60 @@ class WirelessTagData:
         #return rounded_temp
 
 
-    def getTemperature(self, uuid=""):
+    def iterLogInRange(self, uuid="", fromDate='', toDate='', chunksize=_LOG_CHUNKSIZE):
         """
-        If no UUID provided, it will take the first sensor discovered
+        Stream the log of a tag and yield it as frames of at most chunksize rows
         """
-
-        if uuid == "":
-            uuid = self.tagList.keys()[0]
+        url = _GETTEMPCSV + '?uuid={}&fromdate={}&todate={}'.format(uuid, fromDate, toDate)
+        res = self.session.get(url, stream=True)
+        try:
+            if res.status_code != 200:
+                return
+            res.raw.decode_content = True
+            for df in parse_log_csv(res.raw, chunksize):
+                yield df
+        finally:
+            res.close()
+
+    def get_latest(self, uuids=None, max_age=_LATEST_MAX_AGE):
+        """
+        Return {uuid: latest raw reading} for the given tags, or for all tags when uuids is None. A reading requested
+        less than max_age seconds ago is reused, so concurrent callers asking for the same tag share one request.
+        """
+        if uuids is None:
+            uuids = list(self.tagList.keys())
+        futures = {}
+        now = time.time()
+        # a pool per call, so an abandoned instance leaves no idle threads behind; futures started by other calls
+        # are still shared
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with self._latestLock:
+                for uuid in uuids:
+                    entry = self._latest.get(uuid)
+                    if entry is None or now - entry[0] > max_age or (entry[1].done() and entry[1].exception()):
+                        entry = (now, executor.submit(self._fetch_latest, uuid))
+                        self._latest[uuid] = entry
+                    futures[uuid] = entry[1]
+            return dict((uuid, future.result()) for uuid, future in futures.items())
+
+    def _fetch_latest(self, uuid):
         data = {
             "uuid": uuid
         }
-        cookies = self.getAuthToken
+        r = self.post(_GETTEMPDATA, data=json.dumps(data))
+        return r.json()["d"]
 
-        r = requests.post(_GETTEMPDATA, headers=_HEADERS, cookies=cookies, data=json.dumps(data))
-        parsed_response = r.json()
-        temp = Decimal(float(parsed_response["d"]["temp_degC"]))
+    def _uuid_or_first(self, uuid):
+        if uuid == "":
+            uuid = list(self.tagList.keys())[0]
+        return uuid
+
+    def getTemperature(self, uuid=""):
+        """
+        If no UUID provided, it will take the first sensor discovered
+        """
+        uuid = self._uuid_or_first(uuid)
+        temp = Decimal(float(self.get_latest([uuid])[uuid]["temp_degC"]))
         rounded_temp = round(temp, _DECIMALS)
         return rounded_temp
 
@@ -149,36 +259,17 @@ class WirelessTagData:
         """
         If no UUID provided, it will take the first sensor discovered
         """
-
-        if uuid == "":
-            uuid = self.tagList.keys()[0]
-        data = {
-            "uuid": uuid
-        }
-        cookies = self.getAuthToken
-
-        r = requests.post(_GETTEMPDATA, headers=_HEADERS, cookies=cookies, data=json.dumps(data))
-        parsed_response = r.json()
-        humid = Decimal(float(parsed_response["d"]["cap"]))
+        uuid = self._uuid_or_first(uuid)
+        humid = Decimal(float(self.get_latest([uuid])[uuid]["cap"]))
         rounded_humid = round(humid, _DECIMALS)
-
         return rounded_humid
 
     def getBatteryVolt(self, uuid=""):
         """
         If no UUID provided, it will take the first sensor discovered
         """
-
-        if uuid == "":
-            uuid = self.tagList.keys()[0]
-        data = {
-            "uuid": uuid
-        }
-        cookies = self.getAuthToken
-
-        r = requests.post(_GETTEMPDATA, headers=_HEADERS, cookies=cookies, data=json.dumps(data))
-        parsed_response = r.json()
-        return parsed_response["d"]["battery_volts"]
+        uuid = self._uuid_or_first(uuid)
+        return self.get_latest([uuid])[uuid]["battery_volts"]
 
 
 class WirelessTag:
@@ -205,6 +296,7 @@ class WirelessTag:
 
     def import_missing(self):
         self.save_tag_list()
+        self.ts_db.get_last_timestamps([self.ts_name.format(uuid) for uuid in self.uuids])
         for uuid in self.uuids:
             start = self.get_start_timestamp(self.ts_name.format(uuid))
             if not start:
@@ -215,42 +307,27 @@ class WirelessTag:
             for st in np.arange(start, stop, step):
                 fromdate = datetime.fromtimestamp(st).isoformat().replace('+00:00', 'Z')
                 todate = datetime.fromtimestamp(st + step).isoformat().replace('+00:00', 'Z')
-                res = self.ws.getLogInRange(uuid, fromdate, todate)
-                if res:
-                    df = self.convert_to_df(res)
+                for df in self.ws.iterLogInRange(uuid, fromdate, todate):
                     self.ts_db.write_ts(self.ts_name.format(uuid), df)
 
     def save_tag_list(self):
-        self.uuids = self.ws.tagList.keys()
-        for uuid in self.ws.tagList.keys():
-            tag = self.ws.tagList[uuid]
+        tagList = self.ws.tagList
+        self.uuids = list(tagList.keys())
+        tags = []
+        for uuid in self.uuids:
+            tag = dict(tagList[uuid])
             tag['uuid'] = uuid
-            self.metadata_db.insert_one('wirelesstag', tag)
+            tags.append(tag)
+        return self.metadata_db.bulk_upsert('wirelesstag', tags, 'uuid')
 
 
     def convert_to_df(self, s):
         if not s:
             return
-        data = s.replace('"', '').split("\r\n")
-        numberOfRows = len(data)-1
-        columns = ['readtime', 'temperature', 'moisture', 'battery']
-        df = pd.DataFrame(index=np.arange(0, numberOfRows-1), columns=columns)
-        for i in np.arange(1, numberOfRows):
-            values = data[i].split(',')
-            if len(values)==4:
-                row = []
-                m = re.findall(r'(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)', values[0])[0]
-                row_time = datetime(int(m[0]), int(m[1]), int(m[2]), int(m[3]), int(m[4]), int(m[5])).isoformat()
-                row.append(row_time)
-                row.append(float(values[1]))
-                row.append(float(values[2]))
-                row.append(float(values[3]))
-                df.loc[i-1] = row
-        df.index = pd.to_datetime(df["readtime"])
-        df = df.drop("readtime", 1)
-        df.index.name = "readtime"
-        return df
-
+        frames = list(parse_log_csv(BytesIO(s)))
+        if not frames:
+            return pd.DataFrame(columns=_LOG_COLUMNS[1:], index=pd.DatetimeIndex([], name='readtime'))
+        return pd.concat(frames)
 
 
 
@@ -281,7 +358,7 @@ if __name__ == '__main__':
     @sched.scheduled_job('interval', seconds=60*10)
     def poll_data():
         log.info('polling wirelesstag time=%s' % datetime.now())
-    wirelesstag.import_missing()
+        wirelesstag.import_missing()
 
     # Start the schedule
     sched.start()